@@ -1,12 +1,14 @@
 import math
+import functools
 import pandas as pd
 import numpy as np
 import scipy.integrate
-from datetime import timedelta
+from numba import cfunc, njit, prange, types
 import shared
 # import world_data
 # import population
 
+@njit(cache=True)
 def model(Y, x, N, beta0, days0, beta1, gamma, sigma):
     # :param array x: Time step (days)
     # :param int N: Population
@@ -16,7 +18,7 @@ def model(Y, x, N, beta0, days0, beta1, gamma, sigma):
 
     S, E, I, R = Y
 
-    beta = beta0 if x < days0 else beta1
+    beta = beta1 + (beta0 - beta1) * (x < days0)  # beta0 before days0, beta1 after, without a branch
 
     dS = - beta * S * I / N
     dE = beta * S * I / N - sigma * E
@@ -25,8 +27,18 @@ def model(Y, x, N, beta0, days0, beta1, gamma, sigma):
     return dS, dE, dI, dR
 
 
+# numbalsoda.lsoda_sig, spelled out so that importing this module does not import numbalsoda (see batch_integrator)
+lsoda_sig = types.void(types.double, types.CPointer(types.double), types.CPointer(types.double), types.CPointer(types.double))
+
+
+@cfunc(lsoda_sig, cache=True)
+def rhs(x, Y, dY, p):
+    # numbalsoda wrapper around model, p: packed parameters N, beta0, days0, beta1, gamma, sigma
+    dY[0], dY[1], dY[2], dY[3] = model((Y[0], Y[1], Y[2], Y[3]), x, p[0], p[1], p[2], p[3], p[4], p[5])
+
+
 def solve(model, population, E0, beta0, days0, beta1, gamma, sigma, days_total):
-    X = np.arange(days_total)  # time steps list
+    X = np.arange(days_total, dtype=np.float64)  # time steps list
     N0 = population - E0, E0, 0, 0  # S, E, I, R at initial step
 
     y_data_var = scipy.integrate.odeint(model, N0, X, args=(population, beta0, days0, beta1, gamma, sigma))
@@ -35,6 +47,92 @@ def solve(model, population, E0, beta0, days0, beta1, gamma, sigma, days_total):
     return X, S, E, I, R  # note these are all arrays
 
 
+@functools.lru_cache(maxsize=None)
+def batch_integrator():
+    # numbalsoda is imported here and not at the top: importing it compiles its own solve_ivp driver, which takes
+    # seconds and is not needed for single runs
+    from numbalsoda import dop853
+
+    @njit(parallel=True)
+    def integrate_batch(funcptr, N0, t_eval, params, y_data_var):
+        # one independent integration per row of N0 / params, spread over all cores, results go into y_data_var
+        runs = params.shape[0]
+        success = np.empty(runs, dtype=np.bool_)
+        for i in prange(runs):
+            y_data_var[i], success[i] = dop853(funcptr, N0[i], t_eval, params[i], 1.49012e-8, 1.49012e-8)
+        return success
+
+    return integrate_batch
+
+
+def solve_batch(rhs, population, E0, beta0, days0, beta1, gamma, sigma, days_total, out=None):
+    # parameter sweep: each parameter may be a scalar or a 1d array, arrays are broadcast against each other
+    # out: optional float64 buffer of shape (runs, days_total, 4) to reuse across sweeps, S, E, I, R are views into it
+    X = np.arange(days_total, dtype=np.float64)  # time steps list
+    population, E0, beta0, days0, beta1, gamma, sigma = np.broadcast_arrays(
+        *np.atleast_1d(population, E0, beta0, days0, beta1, gamma, sigma))
+    zeros = np.zeros(population.shape)
+    N0 = np.stack([population - E0, E0, zeros, zeros], axis=1).astype(np.float64)  # S, E, I, R at initial step
+    params = np.stack([population, beta0, days0, beta1, gamma, sigma], axis=1).astype(np.float64)
+
+    if out is None:
+        out = np.empty((len(params), days_total, 4))
+    if out.shape != (len(params), days_total, 4) or out.dtype != np.float64:
+        raise ValueError('out must be a float64 array of shape %s, got %s %s'
+                         % ((len(params), days_total, 4), out.dtype, out.shape))
+
+    success = batch_integrator()(rhs.address, N0, X, params, out)
+    if not success.all():
+        print('SEIR integration did not succeed for %i of %i runs, results may be inaccurate.'
+              % ((~success).sum(), len(success)))
+
+    S, E, I, R = out.transpose(2, 0, 1)  # unpack, each is (runs, days)
+    return X, S, E, I, R
+
+
+def gaussian_window(window, std):
+    # same weights as scipy.signal.windows.gaussian / pandas rolling(win_type='gaussian'), without importing scipy.signal
+    n = np.arange(window) - (window - 1.0) / 2.0
+    return np.exp(-n ** 2 / (2 * std * std))
+
+
+@njit(cache=True)
+def postprocess(I, icu_rate, icu_lag, icu_weights, vent_rate, vent_lag, vent_weights,
+                vents_units_start, vents_units_sh1, days_before_shipment):
+    # one pass over the infectious curve, no intermediate arrays for the delays:
+    # needs_icu[i] is the gaussian weighted sum of ICU admissions over the icu_weights window ending icu_lag days earlier,
+    # needs_ventilator the same over ventilator admissions. both windows look back only, so day i is final once reached
+    days = len(I)
+    infectious = np.empty(days, dtype=np.int64)
+    vents = np.empty(days, dtype=np.int64)
+    icu_admissions = np.empty(days)
+    vent_admissions = np.empty(days)
+    needs_icu = np.zeros(days)  # 0 until the first full window
+    needs_ventilator = np.full(days, np.nan)  # not plotted until the first full window
+    icu_start = icu_lag + len(icu_weights) - 1
+    vent_start = vent_lag + len(vent_weights) - 1
+
+    for i in range(days):
+        infectious[i] = np.rint(I[i])
+        vents[i] = vents_units_start if i < days_before_shipment else vents_units_start + vents_units_sh1
+
+        icu_admissions[i] = np.rint(infectious[i] * icu_rate)
+        if i >= icu_start:
+            total = 0.0
+            for j in range(len(icu_weights)):
+                total += icu_weights[j] * icu_admissions[i - icu_start + j]
+            needs_icu[i] = total
+
+        vent_admissions[i] = np.rint(needs_icu[i] * vent_rate)
+        if i >= vent_start:
+            total = 0.0
+            for j in range(len(vent_weights)):
+                total += vent_weights[j] * vent_admissions[i - vent_start + j]
+            needs_ventilator[i] = total
+
+    return infectious, vents, needs_icu, needs_ventilator
+
+
 def run_SEIR(population, date_of_first_infection, date_of_lockdown,
              intensive_units, mean_days_icu,
              vents_units_start, vents_units_sh1, vents_date_sh1,):
@@ -97,30 +195,19 @@ def run_SEIR(population, date_of_first_infection, date_of_lockdown,
 
     X, S, E, I, R = solve(model, population, E0, beta0, days_before_lockdown, beta1, gamma, sigma, days_total)
 
-    demand_dict = {'days': X,
-                   'susceptible': S,
-                   'exposed': E,
-                   'infectious': I,
-                   'recovered': R,
-                   }
-
-    df = pd.DataFrame(demand_dict)
-
-    # Feature engineering
-    df['date'] = df['days'].apply(lambda x: date_of_first_infection + timedelta(days=x))
-    df['vents'] = df.apply(lambda x: vents_units_start if x['date'] < vents_date_sh1 else (vents_units_start + vents_units_sh1), axis=1)
-    df = df.applymap(lambda x: round(x) if isinstance(x, float) else x)
-
-    # Compute time series of patients who require intensive-care unit
-    df['needs_icu'] = df.apply(lambda x: round(x['infectious'] * icu_rate), axis=1)
-    # Number of patients who need an icu at any given time is a rolling function of those who needed it over the last x days
-    df['needs_icu'] = df['needs_icu'].shift(10).rolling(window=mean_days_icu, win_type='gaussian').sum(std=3)
-    df.fillna(0, inplace=True)
-
-    # Compute time series of patients who require mechanical ventilation
-    df['needs_ventilator'] = df.apply(lambda x: round(x['needs_icu'] * vent_rate), axis=1)
-    df['needs_ventilator'] = df['needs_ventilator'].shift(3).rolling(window=3, win_type='gaussian').sum(std=3)
-    df.drop(columns=['exposed'], inplace=True)
+    # Feature engineering, everything that gets plotted is derived from the model output in a single pass
+    # Number of patients who need an icu/ventilator at any given time is a rolling function of those who needed it over the last x days
+    days_before_shipment = (vents_date_sh1 - date_of_first_infection).days
+    icu_weights = gaussian_window(mean_days_icu, 3)
+    vent_weights = gaussian_window(3, 3)
+    infectious, vents, needs_icu, needs_ventilator = postprocess(I, icu_rate, 10, icu_weights, vent_rate, 3, vent_weights,
+                                                                 vents_units_start, vents_units_sh1, days_before_shipment)
+    df = pd.DataFrame({'date': pd.Timestamp(date_of_first_infection) + pd.to_timedelta(X, unit='D'),
+                       'infectious': infectious,
+                       'needs_icu': needs_icu,
+                       'vents': vents,
+                       'needs_ventilator': needs_ventilator,
+                       })
 
 
 
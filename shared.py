@@ -6,16 +6,20 @@ FILENAME = 'covid-19_data.json'
 
 import datetime
 import numpy as np
-import scipy.ndimage.interpolation  # shift function
-
-import world_data
 
 def delay(npArray, days):
-    """shift to right, fill with 0, values fall off!"""
-    return scipy.ndimage.interpolation.shift(npArray, days, cval=0)
+    """shift to right, fill with 0, values fall off! days are rounded to whole days"""
+    days = max(-len(npArray), min(int(round(days)), len(npArray)))
+    shifted = np.zeros_like(npArray)
+    if days >= 0:
+        shifted[days:] = npArray[:len(npArray) - days]
+    else:
+        shifted[:days] = npArray[-days:]
+    return shifted
 
 
 def get_offset_X(XCDR_data, D_model, dataOffset='auto'):
+    import world_data  # not at the top, would load (and maybe download) the data file for every user of shared
     X_days = world_data.dates_to_days(XCDR_data[:,0])
     X_days = np.array(X_days) - min(X_days)
     if dataOffset == 'auto':